@@ -1,16 +1,41 @@
 import pandas as pd
+import numpy as np
 import streamlit as st
 from io import BytesIO
+from pandas.api.types import union_categoricals
 import warnings
 import plotly.express as px
 import urllib.parse
 from fpdf import FPDF
+import xlsxwriter
 import matplotlib.pyplot as plt
 import matplotlib.ticker as mticker
-import re
+import hashlib
+import time
+from functools import partial
 
 warnings.filterwarnings('ignore')
 
+TROCA_SEPARADORES = str.maketrans(',.', '.,')
+PREFIXO_CATEGORIA = '1.2.3.'
+COLUNAS_CATEGORICAS = ['Arquivo', 'Filial', 'Categoria']
+# Coluna da planilha (linha R$) de cada valor monetário; a coluna 7 não é usada
+COLUNAS_VALORES = {
+    'Vl Ampliac.1': 1, 'Valor Original': 2, 'Valor Atualizado': 3,
+    'Deprec. no mes': 4, 'Deprec. no Exerc.': 5, 'Deprec. Acumulada': 6,
+    'Corre Mes M1': 8, 'Corre Bal M1': 9, 'Corr Acum M1': 10,
+    'Cor Dep Mes': 11, 'Cor Dep Exer': 12, 'Cor Dep Acum': 13,
+}
+MAPA_NOMES_FILIAIS = {
+    "GENERAL WATER": "General Water S/A", "GW S/A": "General Water S/A",
+    "G W AGUAS": "GW Águas", "GW ÁGUAS": "GW Águas",
+    "GW SANEAMENTO": "GW Saneamento", "GW SANEA": "GW Saneamento",
+    "GW SISTEMAS": "GW Sistemas", "GW SISTEM": "GW Sistemas",
+    "MATRIZ": "GW Sistemas Matriz"
+}
+# Valores resumidos nas análises, no gráfico e no PDF
+COLUNAS_RESUMO = ['Valor Atualizado', 'Deprec. Acumulada', 'Valor Residual']
+
 # --- CONFIGURAÇÃO DA PÁGINA ---
 st.set_page_config(
     page_title="Dashboard de Ativos Contábeis",
@@ -29,6 +54,8 @@ if 'eixo_x' not in st.session_state:
     st.session_state.eixo_x = None
 if 'eixos_y' not in st.session_state:
     st.session_state.eixos_y = None
+if 'hash_arquivos' not in st.session_state:
+    st.session_state.hash_arquivos = {}
 
 # --- FUNÇÕES DE LÓGICA ---
 
@@ -37,38 +64,64 @@ def padronizar_nome_filial(nome_filial):
     if not isinstance(nome_filial, str):
         return "Não Identificado"
     nome_upper = nome_filial.upper().strip()
-    mapa_nomes = {
-        "GENERAL WATER": "General Water S/A", "GW S/A": "General Water S/A",
-        "G W AGUAS": "GW Águas", "GW ÁGUAS": "GW Águas",
-        "GW SANEAMENTO": "GW Saneamento", "GW SANEA": "GW Saneamento",
-        "GW SISTEMAS": "GW Sistemas", "GW SISTEM": "GW Sistemas",
-        "MATRIZ": "GW Sistemas Matriz"
-    }
-    return mapa_nomes.get(nome_upper, nome_filial)
+    return MAPA_NOMES_FILIAIS.get(nome_upper, nome_filial)
 
 
-def converter_valor(valor):
-    if pd.isna(valor):
-        return 0.0
-    if isinstance(valor, (int, float)):
-        return float(valor)
-    try:
-        valor_str = str(valor).replace('R$', '').strip()
-        if ',' in valor_str and '.' in valor_str:
-            valor_str = valor_str.replace('.', '')
-        valor_str = valor_str.replace(',', '.')
-        return float(valor_str)
-    except (ValueError, TypeError):
-        return 0.0
+def converter_coluna(serie):
+    # Converte uma coluna inteira de valores (R$ 1.234,56 / 1234.56 / vazio) em float
+    if pd.api.types.is_numeric_dtype(serie):
+        return serie.astype(float).fillna(0.0)
+    texto = serie.astype(object).where(serie.notna(), '').astype(str)
+    texto = texto.str.replace('R$', '', regex=False).str.strip()
+    com_milhar = texto.str.contains(',', regex=False) & texto.str.contains(
+        '.', regex=False)
+    texto = texto.mask(com_milhar, texto.str.replace('.', '', regex=False))
+    texto = texto.str.replace(',', '.', regex=False)
+    # to_numeric só aponta o que é número; a conversão exata fica com astype(float)
+    eh_numero = pd.to_numeric(texto, errors='coerce').notna()
+    return texto.where(eh_numero, '0').astype(float)
 
 
 def formatar_valor(valor):
     try:
-        return f"R$ {float(valor):,.2f}".replace(',', 'X').replace('.', ',').replace('X', '.')
+        return f"R$ {float(valor):,.2f}".translate(TROCA_SEPARADORES)
     except (ValueError, TypeError):
         return "R$ 0,00"
 
 
+def formatar_coluna(serie):
+    # Versão vetorizada de formatar_valor para colunas inteiras
+    valores = pd.to_numeric(serie, errors='coerce').fillna(0.0)
+    return 'R$ ' + valores.map('{:,.2f}'.format).str.translate(TROCA_SEPARADORES)
+
+
+def combinar_planilhas(lista_dfs):
+    # Unifica as categorias antes do concat; com categorias diferentes o
+    # pandas converteria as colunas de volta para object
+    for col in COLUNAS_CATEGORICAS:
+        categorias = union_categoricals(
+            [df[col] for df in lista_dfs], sort_categories=True).categories
+        for df in lista_dfs:
+            df[col] = df[col].cat.set_categories(categorias)
+    return pd.concat(lista_dfs, ignore_index=True)
+
+
+def filtrar_categorias(df, filtros):
+    # Filtra pelos códigos das categorias; colunas com todas as opções
+    # selecionadas não entram na máscara
+    mascara = None
+    for col, selecao in filtros.items():
+        categorias = df[col].cat.categories
+        if len(selecao) == len(categorias):
+            continue
+        selecionadas = np.zeros(len(categorias) + 1, dtype=bool)
+        selecionadas[categorias.get_indexer(selecao)] = True
+        # O código -1 (nulo) cai na última posição, que fica False
+        atual = selecionadas[df[col].cat.codes.to_numpy()]
+        mascara = atual if mascara is None else mascara & atual
+    return df if mascara is None else df[mascara]
+
+
 def corrigir_filiais_nao_identificadas(df_arquivo):
     if df_arquivo.empty:
         return df_arquivo
@@ -80,110 +133,229 @@ def corrigir_filiais_nao_identificadas(df_arquivo):
             'Não Identificado', filial_predominante)
     return df_arquivo
 
-# ### LÓGICA DE PROCESSAMENTO FINAL - LEITURA EM PARES DE LINHAS ###
-
-
-def processar_planilha(file):
+# ### LÓGICA DE PROCESSAMENTO FINAL - LEITURA EM PARES DE LINHAS (VETORIZADA) ###
+
+
+def processar_aba(sheet_df, nome_arquivo):
+    if sheet_df.empty:
+        return pd.DataFrame()
+    # A lógica lê até a coluna 13 (Cor Dep Acum); abas mais estreitas ficam com células vazias
+    if sheet_df.shape[1] < 14:
+        sheet_df = sheet_df.reindex(columns=range(14))
+    texto = sheet_df.fillna('').astype(str)
+    texto0 = texto[0]
+    indices = np.arange(len(sheet_df))
+
+    # Captura a Filial: o cabeçalho pode estar em qualquer coluna, então o texto
+    # da linha só é montado onde alguma célula menciona 'Filial'
+    eh_filial = np.zeros(len(sheet_df), dtype=bool)
+    nome_filial = np.full(len(sheet_df), None, dtype=object)
+    menciona_filial = np.logical_or.reduce(
+        [texto[col].str.contains('Filial', regex=False).to_numpy() for col in texto.columns])
+    for i in np.flatnonzero(menciona_filial):
+        row_str = ' '.join(str(x) for x in sheet_df.iloc[i] if pd.notna(x))
+        if 'Filial :' in row_str:
+            nome_extraido = row_str.split(
+                'Filial :')[-1].split(' - ')[-1].strip()
+            eh_filial[i] = True
+            nome_filial[i] = padronizar_nome_filial(nome_extraido)
+
+    # Captura a Categoria do ativo
+    eh_categoria = ~eh_filial & texto0.str.startswith(
+        PREFIXO_CATEGORIA).to_numpy()
+
+    # Identifica a LINHA DE DADOS do ativo
+    # Critérios: coluna 2 (C Custo) e 3 (Cod Base Bem) não são vazias e a coluna 8 (Dt.Aquisicao) parece uma data
+    c_custo = texto0.str.strip()
+    cod_base_bem = texto[2].str.strip()
+    dt_aquisicao = texto[7].str.strip()
+    candidata = (~eh_filial & ~eh_categoria & (c_custo != '').to_numpy() &
+                 (cod_base_bem != '').to_numpy() &
+                 dt_aquisicao.str.contains('/', regex=False).to_numpy())
+
+    # Cada linha de dados consome a linha seguinte (a de valores R$), seja ela
+    # qual for. Em linhas de dados consecutivas, só as posições pares de cada
+    # sequência são lidas como ativo; as ímpares são consumidas pela anterior
+    inicio_seq = candidata & ~np.r_[False, candidata[:-1]]
+    posicao_seq = indices - \
+        np.maximum.accumulate(np.where(inicio_seq, indices, 0))
+    eh_ativo = candidata & (posicao_seq % 2 == 0)
+    consumida = np.r_[False, eh_ativo[:-1]]
+    proxima_tem_rs = np.r_[texto0.str.contains(
+        'R$', regex=False).to_numpy()[1:], False]
+    linhas = np.flatnonzero(eh_ativo & proxima_tem_rs)
+
+    # Filial e Categoria vigentes: o último cabeçalho não consumido acima da linha
+    filial = pd.Series(np.where(eh_filial & ~consumida, nome_filial, None)).ffill().fillna(
+        "Não Identificado")
+    categoria_txt = texto[1].str.strip().where(
+        sheet_df[1].notna(), "Não Identificado")
+    categoria = pd.Series(np.where(eh_categoria & ~consumida, categoria_txt, None)).ffill().fillna(
+        "Não Identificado")
+
+    def coluna_texto(col):
+        return texto[col].iloc[linhas].str.strip().where(
+            sheet_df[col].iloc[linhas].notna(), None).to_numpy()
+
+    dados_aba = {
+        'Arquivo': nome_arquivo,
+        'Filial': filial.iloc[linhas].to_numpy(),
+        'Categoria': categoria.iloc[linhas].to_numpy(),
+        'C Custo': c_custo.iloc[linhas].to_numpy(),
+        'Cod Base Bem': cod_base_bem.iloc[linhas].to_numpy(),
+        'Codigo Item': coluna_texto(3),
+        'Tipo Ativo': coluna_texto(4),
+        'Descr. Sint.': coluna_texto(5),
+        'Tipo Depr.': coluna_texto(6),
+        'Dt.Aquisicao': dt_aquisicao.iloc[linhas].to_numpy(),
+        'Data Baixa': coluna_texto(8),
+        'Quantidade': converter_coluna(texto[9].iloc[linhas]).to_numpy(),
+        'Num.Plaqueta': coluna_texto(10),
+        'Item Despesa': coluna_texto(11),
+        'ClVl Despesa': coluna_texto(12),
+    }
+    # Valores da linha R$ logo abaixo de cada ativo
+    for nome_coluna, col in COLUNAS_VALORES.items():
+        dados_aba[nome_coluna] = converter_coluna(
+            sheet_df[col].iloc[linhas + 1]).to_numpy()
+    dados_aba['Valor Residual'] = dados_aba['Valor Atualizado'] - \
+        dados_aba['Deprec. Acumulada']
+    return pd.DataFrame(dados_aba)
+
+
+def hash_arquivo(file):
+    # Calculado uma vez por upload; nos reruns o cache usa só este resumo
+    # em vez de hashear o conteúdo inteiro do arquivo
+    if file.file_id not in st.session_state.hash_arquivos:
+        st.session_state.hash_arquivos[file.file_id] = hashlib.blake2b(
+            file.getvalue(), digest_size=16).hexdigest()
+    return st.session_state.hash_arquivos[file.file_id]
+
+
+# Só em memória, limitado a max_entries: as planilhas da empresa não ficam
+# gravadas no servidor. Erros de leitura são levantados e tratados fora da
+# função, para que uma falha não fique guardada no cache
+@st.cache_data(show_spinner=False, max_entries=64)
+def processar_planilha(hash_conteudo, nome_arquivo, _file):
+    dados_processados = []
+
+    # Um só ExcelFile para todas as abas, fechado ao fim da leitura
+    with pd.ExcelFile(_file, engine='calamine') as xl:
+        for sheet_name in xl.sheet_names:
+            sheet_df = xl.parse(sheet_name, header=None, dtype=str)
+            df_aba = processar_aba(sheet_df, nome_arquivo)
+            if not df_aba.empty:
+                dados_processados.append(df_aba)
+
+    if dados_processados:
+        df_final = corrigir_filiais_nao_identificadas(
+            pd.concat(dados_processados, ignore_index=True))
+        for col in COLUNAS_CATEGORICAS:
+            df_final[col] = df_final[col].astype('category')
+        return df_final, None
+
+    return None, f"Nenhum registro de ativo válido encontrado em {nome_arquivo}."
+
+
+# Nas agregações abaixo o frame filtrado entra com prefixo _ e fica fora do
+# hash do cache; a chave são os arquivos carregados e a seleção dos filtros
+@st.cache_data(show_spinner=False, max_entries=64)
+def agregar_base(chave_dados, chave_filtros, _dados_filtrados):
+    # Um único groupby sobre as linhas; as análises por eixo saem deste resumo
+    return _dados_filtrados.groupby(COLUNAS_CATEGORICAS, observed=True).agg(
+        Contagem=('Arquivo', 'count'), **{col: (col, 'sum') for col in COLUNAS_RESUMO}).reset_index()
+
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def agregar_por(chave_dados, chave_filtros, _dados_filtrados, coluna):
+    base = agregar_base(chave_dados, chave_filtros, _dados_filtrados)
+    return base.groupby(coluna, observed=True).agg(Contagem=(
+        'Contagem', 'sum'), Valor_Total=('Valor Atualizado', 'sum')).reset_index()
+
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def agrupar_grafico(chave_dados, chave_filtros, _dados_filtrados, eixo_x, eixos_y):
+    base = agregar_base(chave_dados, chave_filtros, _dados_filtrados)
+    return base.groupby(
+        eixo_x, observed=True)[eixos_y].sum().reset_index()
+
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def montar_grafico(chave_dados, chave_filtros, _dados_agrupados, tipo_grafico, eixo_x, eixos_y):
+    fig_plotly = None
+    # Formato largo direto no plotly: y com a lista de métricas dispensa o
+    # pd.melt, e os rótulos mantêm os nomes 'Valor' e 'Métrica'
+    rotulos = {'value': 'Valor', 'variable': 'Métrica'}
+    if tipo_grafico == "Barras":
+        fig_plotly = px.bar(_dados_agrupados, x=eixo_x, y=list(eixos_y), labels=rotulos,
+                            text_auto='.2s', barmode='group')
+        fig_plotly.update_traces(textposition='outside')
+    elif tipo_grafico == "Linhas":
+        fig_plotly = px.line(
+            _dados_agrupados, x=eixo_x, y=list(eixos_y), labels=rotulos, markers=True)
+    elif tipo_grafico == "Pizza":
+        metrica_unica = eixos_y[0]
+        fig_plotly = px.pie(
+            _dados_agrupados, names=eixo_x, values=metrica_unica, hole=0.3)
+        fig_plotly.update_traces(
+            textposition='outside', textinfo='percent+label')
+
+    if fig_plotly:
+        fig_plotly.update_layout(title=f'Análise de {", ".join(eixos_y)} por {eixo_x}', uniformtext_minsize=8, uniformtext_mode='hide', margin=dict(
+            t=80, b=50), plot_bgcolor='rgba(0,0,0,0)', legend_title_text='')
+    return fig_plotly
+
+
+# Formatar as colunas monetárias é a parte cara da aba de detalhes; o frame
+# pronto ocupa mais memória, por isso guarda menos entradas
+@st.cache_data(show_spinner=False, max_entries=16)
+def montar_exibicao(chave_dados, chave_filtros, _dados_filtrados, colunas, colunas_monetarias):
+    # Sem copiar o frame inteiro: só as colunas monetárias viram texto
+    return _dados_filtrados[colunas].assign(**{
+        col: formatar_coluna(_dados_filtrados[col])
+        for col in colunas_monetarias if col in _dados_filtrados.columns})
+
+
+@st.cache_data(show_spinner=False)
+def gerar_imagem_grafico(dados_grafico, tipo_grafico, eixo_x, eixos_y):
+    # Cacheado pelos dados agregados e pela configuração do gráfico: baixar o
+    # mesmo relatório de novo não redesenha a figura
+    fig, ax = plt.subplots(figsize=(11, 5))
     try:
-        xl = pd.ExcelFile(file)
-        dados_processados = []
+        if tipo_grafico in ['Barras', 'Linhas']:
+            df_plot = dados_grafico.set_index(eixo_x)
+            df_plot.plot(
+                kind='bar' if tipo_grafico == 'Barras' else 'line',
+                ax=ax,
+                rot=45,
+                grid=True
+            )
+            ax.set_title(f'Análise por {eixo_x}')
+            ax.set_ylabel('Valores (R$)')
+            ax.yaxis.set_major_formatter(
+                mticker.FuncFormatter(lambda x, p: f'R$ {x:,.0f}'))
+            ax.legend(title='Métricas')
+
+        elif tipo_grafico == 'Pizza':
+            metrica_unica = eixos_y[0]
+            ax.pie(
+                dados_grafico[metrica_unica],
+                labels=dados_grafico[eixo_x],
+                autopct='%1.1f%%',
+                startangle=90
+            )
+            ax.set_title(f'Distribuição de {metrica_unica} por {eixo_x}')
+            ax.axis('equal')
 
-        for sheet_name in xl.sheet_names:
-            sheet_df = pd.read_excel(
-                xl, sheet_name=sheet_name, header=None, dtype=str)
-
-            filial_atual = "Não Identificado"
-            categoria_atual = "Não Identificado"
-
-            # Usamos um iterador para poder avançar para a próxima linha manualmente
-            rows_iter = sheet_df.iterrows()
-            for index, row in rows_iter:
-                if row.isnull().all():
-                    continue
-
-                # Captura a Filial
-                row_str = ' '.join(str(x) for x in row if pd.notna(x))
-                if 'Filial :' in row_str:
-                    nome_extraido = row_str.split(
-                        'Filial :')[-1].split(' - ')[-1].strip()
-                    filial_atual = padronizar_nome_filial(nome_extraido)
-                    continue
-
-                # Captura a Categoria do ativo
-                if str(row.iloc[0]).startswith('1.2.3.'):
-                    categoria_atual = str(row.iloc[1]).strip() if pd.notna(
-                        row.iloc[1]) else "Não Identificado"
-                    continue
-
-                # Identifica a LINHA DE DADOS do ativo
-                # Critérios: coluna 2 (C Custo) e 3 (Cod Base Bem) não são vazias e a coluna 8 (Dt.Aquisicao) parece uma data
-                c_custo = str(row.iloc[0]).strip() if pd.notna(
-                    row.iloc[0]) else None
-                cod_base_bem = str(row.iloc[2]).strip(
-                ) if pd.notna(row.iloc[2]) else None
-                dt_aquisicao = str(row.iloc[7]).strip(
-                ) if pd.notna(row.iloc[7]) else None
-
-                if c_custo and cod_base_bem and dt_aquisicao and '/' in dt_aquisicao:
-                    dados_do_ativo = {
-                        'Arquivo': file.name,
-                        'Filial': filial_atual,
-                        'Categoria': categoria_atual,
-                        'C Custo': c_custo,
-                        'Cod Base Bem': cod_base_bem,
-                        'Codigo Item': str(row.iloc[3]).strip() if pd.notna(row.iloc[3]) else None,
-                        'Tipo Ativo': str(row.iloc[4]).strip() if pd.notna(row.iloc[4]) else None,
-                        'Descr. Sint.': str(row.iloc[5]).strip() if pd.notna(row.iloc[5]) else None,
-                        'Tipo Depr.': str(row.iloc[6]).strip() if pd.notna(row.iloc[6]) else None,
-                        'Dt.Aquisicao': dt_aquisicao,
-                        'Data Baixa': str(row.iloc[8]).strip() if pd.notna(row.iloc[8]) else None,
-                        'Quantidade': converter_valor(str(row.iloc[9]).strip() if pd.notna(row.iloc[9]) else '0'),
-                        'Num.Plaqueta': str(row.iloc[10]).strip() if pd.notna(row.iloc[10]) else None,
-                        'Item Despesa': str(row.iloc[11]).strip() if pd.notna(row.iloc[11]) else None,
-                        'ClVl Despesa': str(row.iloc[12]).strip() if pd.notna(row.iloc[12]) else None,
-                    }
-
-                    # Tenta ler a PRÓXIMA linha, que deve ser a de valores (R$)
-                    try:
-                        _, next_row = next(rows_iter)
-                        if pd.notna(next_row.iloc[0]) and 'R$' in str(next_row.iloc[0]):
-                            valores = [converter_valor(v)
-                                       for v in next_row.iloc[1:14]]
-
-                            dados_do_ativo.update({
-                                'Vl Ampliac.1': valores[0] if len(valores) > 0 else 0,
-                                'Valor Original': valores[1] if len(valores) > 1 else 0,
-                                'Valor Atualizado': valores[2] if len(valores) > 2 else 0,
-                                'Deprec. no mes': valores[3] if len(valores) > 3 else 0,
-                                'Deprec. no Exerc.': valores[4] if len(valores) > 4 else 0,
-                                'Deprec. Acumulada': valores[5] if len(valores) > 5 else 0,
-                                'Corre Mes M1': valores[7] if len(valores) > 7 else 0,
-                                'Corre Bal M1': valores[8] if len(valores) > 8 else 0,
-                                'Corr Acum M1': valores[9] if len(valores) > 9 else 0,
-                                'Cor Dep Mes': valores[10] if len(valores) > 10 else 0,
-                                'Cor Dep Exer': valores[11] if len(valores) > 11 else 0,
-                                'Cor Dep Acum': valores[12] if len(valores) > 12 else 0,
-                            })
-
-                            valor_atualizado = dados_do_ativo.get(
-                                'Valor Atualizado', 0)
-                            deprec_acumulada = dados_do_ativo.get(
-                                'Deprec. Acumulada', 0)
-                            dados_do_ativo['Valor Residual'] = valor_atualizado - \
-                                deprec_acumulada
-
-                            dados_processados.append(dados_do_ativo)
-                    except StopIteration:
-                        # Chegou ao fim do arquivo
-                        break
-
-        if dados_processados:
-            df_final = pd.DataFrame(dados_processados)
-            return corrigir_filiais_nao_identificadas(df_final), None
-
-        return None, f"Nenhum registro de ativo válido encontrado em {file.name}."
-    except Exception as e:
-        return None, f"Erro crítico ao processar {file.name}: {e}"
+        plt.tight_layout()
+
+        # SVG vetorial: evita rasterizar a figura em 300 dpi e o fpdf2 embute direto
+        img_buffer = BytesIO()
+        fig.savefig(img_buffer, format='svg', metadata={
+                    'Date': None, 'Creator': None, 'Format': None, 'Type': None})
+        return img_buffer.getvalue()
+    finally:
+        plt.close(fig)
 
 
 def criar_pdf_completo(buffer, df_filtrado, dados_grafico, tipo_grafico, eixo_x, eixos_y):
@@ -201,77 +373,74 @@ def criar_pdf_completo(buffer, df_filtrado, dados_grafico, tipo_grafico, eixo_x,
 
     if dados_grafico is not None:
         try:
-            fig, ax = plt.subplots(figsize=(11, 5))
-
-            if tipo_grafico in ['Barras', 'Linhas']:
-                df_plot = dados_grafico.set_index(eixo_x)
-                df_plot.plot(
-                    kind='bar' if tipo_grafico == 'Barras' else 'line',
-                    ax=ax,
-                    rot=45,
-                    grid=True
-                )
-                ax.set_title(f'Análise por {eixo_x}')
-                ax.set_ylabel('Valores (R$)')
-                ax.yaxis.set_major_formatter(
-                    mticker.FuncFormatter(lambda x, p: f'R$ {x:,.0f}'))
-                ax.legend(title='Métricas')
-
-            elif tipo_grafico == 'Pizza':
-                metrica_unica = eixos_y[0]
-                ax.pie(
-                    dados_grafico[metrica_unica],
-                    labels=dados_grafico[eixo_x],
-                    autopct='%1.1f%%',
-                    startangle=90
-                )
-                ax.set_title(f'Distribuição de {metrica_unica} por {eixo_x}')
-                ax.axis('equal')
-
-            plt.tight_layout()
-
-            img_buffer = BytesIO()
-            fig.savefig(img_buffer, format='png', dpi=300)
-            img_buffer.seek(0)
+            img_bytes = gerar_imagem_grafico(
+                dados_grafico, tipo_grafico, eixo_x, eixos_y)
 
             pdf.set_font("Arial", "B", 14)
             pdf.cell(0, 10, "Gráfico Analítico", 0, 1, 'L')
-            pdf.image(img_buffer, x=None, y=None, w=277)
+            pdf.image(BytesIO(img_bytes), x=None, y=None, w=277)
             pdf.ln(5)
 
         except Exception as e:
             pdf.set_font("Arial", "", 10)
             pdf.cell(
                 0, 10, f"Nao foi possivel renderizar o grafico no PDF: {e}", 0, 1, 'L')
-        finally:
-            plt.close(fig)
 
     pdf.set_font("Arial", "B", 14)
     pdf.cell(0, 10, "Dados Agregados por Filial e Categoria", 0, 1, 'L')
     pdf.ln(5)
     colunas_para_somar = ['Valor Atualizado',
                           'Deprec. Acumulada', 'Valor Residual']
-    df_agregado = df_filtrado.groupby(['Filial', 'Categoria'])[
+    df_agregado = df_filtrado.groupby(['Filial', 'Categoria'], observed=True)[
         colunas_para_somar].sum().reset_index()
-    for col in colunas_para_somar:
-        df_agregado[col] = df_agregado[col].apply(formatar_valor)
     col_widths = {'Filial': 60, 'Categoria': 100, 'Valor Atualizado': 35,
                   'Deprec. Acumulada': 40, 'Valor Residual': 35}
     pdf.set_font("Arial", "B", 9)
     for col_name in col_widths.keys():
-        pdf.cell(col_widths[col_name], 10, col_name, 1, 0, 'C')
+        pdf.cell(col_widths[col_name], 10, col_name, border=1, align='C')
     pdf.ln()
     pdf.set_font("Arial", "", 8)
-    for _, row in df_agregado.iterrows():
-        for col_name in col_widths.keys():
-            cell_text = str(row[col_name]).encode(
-                'latin-1', 'replace').decode('latin-1')
-            pdf.cell(col_widths[col_name], 10, cell_text, 1, 0, 'L')
+    # Monta a tabela inteira como matriz de strings antes do laço do PDF; só os
+    # textos precisam ser convertidos para latin-1 (os valores formatados são ASCII)
+    celulas = np.column_stack(
+        [df_agregado[col].astype(str).str.encode('latin-1', 'replace').str.decode('latin-1')
+         for col in ['Filial', 'Categoria']] +
+        [formatar_coluna(df_agregado[col]) for col in colunas_para_somar])
+    larguras = list(col_widths.values())
+    for linha in celulas.tolist():
+        for largura, cell_text in zip(larguras, linha):
+            # Sem o 'ln' posicional (obsoleto no fpdf2), que emite um aviso a cada célula
+            pdf.cell(largura, 10, cell_text, border=1, align='L')
         pdf.ln()
 
     pdf.output(buffer)
 
 
+# Os relatórios só são gerados quando o usuário clica no botão de download
+def gerar_excel(df):
+    output_excel = BytesIO()
+    # constant_memory grava e descarta cada linha, mas exige escrita em ordem de
+    # linha (o to_excel do pandas escreve por coluna); sem a detecção de URLs,
+    # que testa cada célula de texto
+    workbook = xlsxwriter.Workbook(output_excel, {
+        'constant_memory': True, 'strings_to_urls': False, 'nan_inf_to_errors': True})
+    worksheet = workbook.add_worksheet('Dados_Filtrados')
+    worksheet.write_row(0, 0, df.columns.tolist())
+    colunas = [df[col].astype(object).where(df[col].notna(), None).tolist()
+               for col in df.columns]
+    for i, linha in enumerate(zip(*colunas), start=1):
+        worksheet.write_row(i, 0, linha)
+    workbook.close()
+    return output_excel.getvalue()
+
+
+def gerar_pdf(df_filtrado, dados_grafico, tipo_grafico, eixo_x, eixos_y):
+    pdf_buffer = BytesIO()
+    criar_pdf_completo(pdf_buffer, df_filtrado, dados_grafico,
+                       tipo_grafico, eixo_x, eixos_y)
+    return pdf_buffer.getvalue()
+
+
 # --- ESTRUTURA DA APLICAÇÃO ---
 st.title("Dashboard de Ativos Contábeis")
 
@@ -293,26 +462,37 @@ uploaded_files = st.file_uploader("Escolha os arquivos Excel de ativos", type=[
                                   'xlsx', 'xls'], accept_multiple_files=True)
 
 if uploaded_files:
-    all_data, errors = [], []
+    all_data, errors, chave_dados = [], [], []
     progress_bar = st.progress(0, text="Iniciando...")
+    # Com o cache a maioria dos arquivos sai na hora; a barra é atualizada no
+    # máximo a cada 0,1 s e sempre no último arquivo
+    ultima_atualizacao = 0.0
     for i, file in enumerate(uploaded_files):
-        progress_bar.progress((i + 1) / len(uploaded_files),
-                              text=f"Processando: {file.name}")
-        dados, erro = processar_planilha(file)
+        if i == len(uploaded_files) - 1 or time.monotonic() - ultima_atualizacao > 0.1:
+            progress_bar.progress((i + 1) / len(uploaded_files),
+                                  text=f"Processando: {file.name}")
+            ultima_atualizacao = time.monotonic()
+        try:
+            dados, erro = processar_planilha(
+                hash_arquivo(file), file.name, file)
+        except Exception as e:
+            dados, erro = None, f"Erro crítico ao processar {file.name}: {e}"
         if dados is not None and not dados.empty:
             all_data.append(dados)
+            chave_dados.append((hash_arquivo(file), file.name))
         if erro:
             errors.append(erro)
 
     if all_data:
-        dados_combinados = pd.concat(all_data, ignore_index=True)
+        dados_combinados = combinar_planilhas(all_data)
         st.success(
             f"Processamento concluído! {len(all_data)} arquivo(s) válidos e {len(dados_combinados)} registros encontrados.")
 
         col1, col2, col3 = st.columns(3)
-        arquivos_options = sorted(dados_combinados['Arquivo'].unique())
-        filiais_options = sorted(dados_combinados['Filial'].unique())
-        categorias_options = sorted(dados_combinados['Categoria'].unique())
+        # As categorias já saem ordenadas de combinar_planilhas
+        arquivos_options = dados_combinados['Arquivo'].cat.categories.tolist()
+        filiais_options = dados_combinados['Filial'].cat.categories.tolist()
+        categorias_options = dados_combinados['Categoria'].cat.categories.tolist()
         with col1:
             selecao_arquivo = st.multiselect(
                 "Arquivo:", ["Selecionar Todos"] + arquivos_options, default="Selecionar Todos")
@@ -326,26 +506,28 @@ if uploaded_files:
         filtro_arquivo = arquivos_options if "Selecionar Todos" in selecao_arquivo else selecao_arquivo
         filtro_filial = filiais_options if "Selecionar Todos" in selecao_filial else selecao_filial
         filtro_categoria = categorias_options if "Selecionar Todos" in selecao_categoria else selecao_categoria
-        dados_filtrados = dados_combinados[
-            (dados_combinados['Arquivo'].isin(filtro_arquivo)) &
-            (dados_combinados['Filial'].isin(filtro_filial)) &
-            (dados_combinados['Categoria'].isin(filtro_categoria))
-        ]
+        dados_filtrados = filtrar_categorias(dados_combinados, {
+            'Arquivo': filtro_arquivo, 'Filial': filtro_filial, 'Categoria': filtro_categoria})
+        # Conteúdo e nome de cada arquivo que entrou nos dados: reenviar os mesmos
+        # arquivos reaproveita o cache, e um arquivo que falhou antes e foi lido
+        # agora muda a chave
+        chave_dados = tuple(chave_dados)
+        chave_filtros = (tuple(sorted(filtro_arquivo)), tuple(
+            sorted(filtro_filial)), tuple(sorted(filtro_categoria)))
 
         col1, col2, col3, col4 = st.columns(4)
+        totais = dados_filtrados[COLUNAS_RESUMO].sum()
         col1.metric("Registros Filtrados", f"{len(dados_filtrados):,}")
         col2.metric("Valor Total Atualizado", formatar_valor(
-            dados_filtrados["Valor Atualizado"].sum()))
+            totais["Valor Atualizado"]))
         col3.metric("Depreciação Acumulada", formatar_valor(
-            dados_filtrados["Deprec. Acumulada"].sum()))
+            totais["Deprec. Acumulada"]))
         col4.metric("Valor Residual Total", formatar_valor(
-            dados_filtrados["Valor Residual"].sum()))
+            totais["Valor Residual"]))
 
         tab1, tab2, tab3 = st.tabs(
             ["Dados Detalhados", "Análise por Filial", "Análise por Categoria"])
         with tab1:
-            df_display = dados_filtrados.copy()
-
             colunas_para_exibir = [
                 'Arquivo', 'Filial', 'Categoria', 'C Custo', 'Cod Base Bem', 'Codigo Item', 'Tipo Ativo',
                 'Descr. Sint.', 'Tipo Depr.', 'Dt.Aquisicao', 'Data Baixa',
@@ -360,33 +542,29 @@ if uploaded_files:
                 'Deprec. no Exerc.', 'Deprec. Acumulada', 'Valor Residual', 'Corre Mes M1', 'Corre Bal M1',
                 'Corr Acum M1', 'Cor Dep Mes', 'Cor Dep Exer', 'Cor Dep Acum'
             ]
-            for col in colunas_monetarias:
-                if col in df_display.columns:
-                    df_display[col] = df_display[col].apply(formatar_valor)
-
             colunas_existentes = [
-                col for col in colunas_para_exibir if col in df_display.columns]
-            st.dataframe(df_display[colunas_existentes],
-                         use_container_width=True, height=500)
+                col for col in colunas_para_exibir if col in dados_filtrados.columns]
+            df_display = montar_exibicao(
+                chave_dados, chave_filtros, dados_filtrados, colunas_existentes, colunas_monetarias)
+            st.dataframe(df_display, use_container_width=True, height=500)
 
         with tab2:
-            analise_filial = dados_filtrados.groupby('Filial').agg(Contagem=(
-                'Arquivo', 'count'), Valor_Total=('Valor Atualizado', 'sum')).reset_index()
-            analise_filial['Valor_Total'] = analise_filial['Valor_Total'].apply(
-                formatar_valor)
+            analise_filial = agregar_por(
+                chave_dados, chave_filtros, dados_filtrados, 'Filial')
+            analise_filial['Valor_Total'] = formatar_coluna(
+                analise_filial['Valor_Total'])
             st.dataframe(analise_filial, use_container_width=True)
         with tab3:
-            analise_categoria = dados_filtrados.groupby('Categoria').agg(Contagem=(
-                'Arquivo', 'count'), Valor_Total=('Valor Atualizado', 'sum')).reset_index()
-            analise_categoria['Valor_Total'] = analise_categoria['Valor_Total'].apply(
-                formatar_valor)
+            analise_categoria = agregar_por(
+                chave_dados, chave_filtros, dados_filtrados, 'Categoria')
+            analise_categoria['Valor_Total'] = formatar_coluna(
+                analise_categoria['Valor_Total'])
             st.dataframe(analise_categoria, use_container_width=True)
 
         st.markdown("---")
         st.header("Gráfico Interativo")
 
-        opcoes_eixo_y = ["Valor Atualizado",
-                         "Deprec. Acumulada", "Valor Residual"]
+        opcoes_eixo_y = COLUNAS_RESUMO
         col_graf1, col_graf2, col_graf3 = st.columns(3)
         with col_graf1:
             tipo_grafico = st.selectbox("Escolha o Tipo de Gráfico:", [
@@ -404,32 +582,16 @@ if uploaded_files:
                                          "Valor Atualizado", "Valor Residual"])
 
         if not dados_filtrados.empty and eixo_x and eixos_y:
-            dados_agrupados = dados_filtrados.groupby(
-                eixo_x)[eixos_y].sum().reset_index()
-
-            fig_plotly = None
-            if tipo_grafico == "Barras":
-                dados_grafico_melted = pd.melt(dados_agrupados, id_vars=[
-                                               eixo_x], value_vars=eixos_y, var_name='Métrica', value_name='Valor')
-                fig_plotly = px.bar(dados_grafico_melted, x=eixo_x, y='Valor',
-                                    color='Métrica', text_auto='.2s', barmode='group')
-                fig_plotly.update_traces(textposition='outside')
-            elif tipo_grafico == "Linhas":
-                dados_grafico_melted = pd.melt(dados_agrupados, id_vars=[
-                                               eixo_x], value_vars=eixos_y, var_name='Métrica', value_name='Valor')
-                fig_plotly = px.line(
-                    dados_grafico_melted, x=eixo_x, y='Valor', color='Métrica', markers=True)
-            elif tipo_grafico == "Pizza":
-                metrica_unica = eixos_y[0]
-                fig_plotly = px.pie(
-                    dados_agrupados, names=eixo_x, values=metrica_unica, hole=0.3)
-                fig_plotly.update_traces(
-                    textposition='outside', textinfo='percent+label')
+            dados_agrupados = agrupar_grafico(
+                chave_dados, chave_filtros, dados_filtrados, eixo_x, eixos_y)
+
+            fig_plotly = montar_grafico(
+                chave_dados, chave_filtros, dados_agrupados, tipo_grafico, eixo_x, eixos_y)
 
             if fig_plotly:
-                fig_plotly.update_layout(title=f'Análise de {", ".join(eixos_y)} por {eixo_x}', uniformtext_minsize=8, uniformtext_mode='hide', margin=dict(
-                    t=80, b=50), plot_bgcolor='rgba(0,0,0,0)', legend_title_text='')
-                st.plotly_chart(fig_plotly, use_container_width=True)
+                # A key fixa mantém o mesmo componente no navegador entre os reruns
+                st.plotly_chart(fig_plotly, use_container_width=True,
+                                key="grafico_principal")
 
                 st.session_state.dados_grafico = dados_agrupados
                 st.session_state.tipo_grafico = tipo_grafico
@@ -446,36 +608,32 @@ if uploaded_files:
         col_download1, col_download2 = st.columns(2)
 
         with col_download1:
-            output_excel = BytesIO()
-            with pd.ExcelWriter(output_excel, engine='xlsxwriter') as writer:
-                colunas_para_exportar = [
-                    col for col in colunas_para_exibir if col in dados_filtrados.columns]
-                dados_filtrados[colunas_para_exportar].to_excel(
-                    writer, sheet_name='Dados_Filtrados', index=False)
+            colunas_para_exportar = [
+                col for col in colunas_para_exibir if col in dados_filtrados.columns]
             st.download_button(
                 label="📥 Baixar Relatório em Excel",
-                data=output_excel.getvalue(),
+                data=partial(gerar_excel, dados_filtrados[colunas_para_exportar]),
                 file_name="relatorio_ativos_filtrado.xlsx",
                 mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                on_click="ignore",
                 use_container_width=True
             )
 
         with col_download2:
             if st.session_state.dados_grafico is not None:
-                pdf_buffer = BytesIO()
-                criar_pdf_completo(
-                    pdf_buffer,
-                    dados_filtrados,
-                    st.session_state.dados_grafico,
-                    st.session_state.tipo_grafico,
-                    st.session_state.eixo_x,
-                    st.session_state.eixos_y
-                )
                 st.download_button(
                     label="📄 Baixar Relatório Completo (PDF)",
-                    data=pdf_buffer.getvalue(),
+                    data=partial(
+                        gerar_pdf,
+                        dados_filtrados,
+                        st.session_state.dados_grafico,
+                        st.session_state.tipo_grafico,
+                        st.session_state.eixo_x,
+                        st.session_state.eixos_y
+                    ),
                     file_name="relatorio_completo.pdf",
                     mime="application/pdf",
+                    on_click="ignore",
                     use_container_width=True
                 )
             else: